@@ -1,10 +1,9 @@
 import streamlit as st
 import pandas as pd
-import folium
-from folium.plugins import MarkerCluster, HeatMap, Fullscreen
-from streamlit_folium import st_folium
+import numpy as np
 import zipfile
-import plotly.express as px
+import io
+import os
 
 # ------------------------------------------------------
 # 1. CONFIGURACIÓN DE LA PÁGINA
@@ -18,127 +17,217 @@ st.set_page_config(
 # ------------------------------------------------------
 # 2. CARGA DE DATOS INTELIGENTE
 # ------------------------------------------------------
+ARCHIVO_ZIP = 'fires-all.csv.zip'
+ARCHIVO_META = 'master_data.xlsx'
+
+class ErrorMaestros(Exception):
+    """No se pudo leer master_data.xlsx (se distingue de los errores del ZIP)."""
+
+def marca_archivo(ruta):
+    """Fecha de modificación del archivo (o None): clave de caché barata, sin hashear DataFrames."""
+    return os.path.getmtime(ruta) if os.path.exists(ruta) else None
 
 @st.cache_data
-def cargar_maestros():
-    """Carga master_data.xlsx para traducir códigos a texto."""
-    archivo_meta = 'master_data.xlsx'
+def cargar_maestros(marca):
+    """Carga master_data.xlsx para traducir códigos a texto.
+    
+    `marca` (ver marca_archivo) no se usa dentro: solo es la clave de la caché.
+    Si el archivo no se puede leer lanza ErrorMaestros, que st.cache_data no guarda.
+    """
     maestros = {}
     
     try:
-        df_meta = pd.read_excel(archivo_meta)
+        df_meta = pd.read_excel(ARCHIVO_META)
         
-        # Diccionarios de mapeo (asegurando limpieza)
+        # Series de mapeo id -> texto (asegurando limpieza); .map(Series) es vectorizado
+        # y el índice debe ser único (la hoja repite la comunidad en cada provincia)
         if {'idcomunidad', 'comunidad'}.issubset(df_meta.columns):
             temp = df_meta[['idcomunidad', 'comunidad']].dropna()
-            maestros['comunidades'] = dict(zip(temp['idcomunidad'], temp['comunidad']))
+            maestros['comunidades'] = temp.drop_duplicates('idcomunidad', keep='last').set_index('idcomunidad')['comunidad']
             
         if {'idprovincia', 'provincia'}.issubset(df_meta.columns):
             temp = df_meta[['idprovincia', 'provincia']].dropna()
-            maestros['provincias'] = dict(zip(temp['idprovincia'], temp['provincia']))
+            maestros['provincias'] = temp.drop_duplicates('idprovincia', keep='last').set_index('idprovincia')['provincia']
             
         if {'causa', 'causa_label'}.issubset(df_meta.columns):
             temp = df_meta[['causa', 'causa_label']].dropna()
-            maestros['causas'] = dict(zip(temp['causa'], temp['causa_label']))
+            maestros['causas'] = temp.drop_duplicates('causa', keep='last').set_index('causa')['causa_label']
             
     except Exception as e:
-        st.warning(f"⚠️ No se pudo cargar master_data.xlsx: {e}")
-        return {}
+        raise ErrorMaestros(e) from e
         
     return maestros
 
-@st.cache_data
-def cargar_datos():
-    """Carga y limpia los datos automáticamente desde el ZIP local."""
-    archivo_zip = 'fires-all.csv.zip'
+def _parse_csv(archivo_zip):
+    """Lee el CSV del ZIP con sus tipos y fechas (el paso más costoso de la carga).
     
+    Sin st.cache_data propio: la copia Parquet hace de caché, y así no se guarda en memoria
+    un segundo DataFrame además del de cargar_datos.
+    """
+    # Subir la versión del nombre si cambia el contenido de la copia (p. ej. el orden)
+    archivo_parquet = 'fires-all.v3.parquet'
+
+    # Solo leemos las columnas que usa el monitor, ya con su tipo final
+    columnas = ['fecha', 'lat', 'lng', 'municipio', 'superficie', 'gastos', 'perdidas',
+                'idcomunidad', 'idprovincia', 'causa']
+    tipos = {
+        'lat': 'float32', 'lng': 'float32', 'superficie': 'float32',
+        'gastos': 'float32', 'perdidas': 'float32',
+        'idcomunidad': 'Int16', 'idprovincia': 'Int16'
+    }
+
+    # 0. Reutilizar la copia Parquet si es más reciente que el ZIP y tiene el esquema actual
+    if os.path.exists(archivo_parquet):
+        if not os.path.exists(archivo_zip) or os.path.getmtime(archivo_parquet) > os.path.getmtime(archivo_zip):
+            try:
+                df = pd.read_parquet(archivo_parquet)
+                esquema = {**tipos, 'anio': 'int16'}
+                if (isinstance(df.index, pd.DatetimeIndex)
+                        and set(columnas[1:] + ['anio']) <= set(df.columns)
+                        and all(str(df[c].dtype) == t for c, t in esquema.items())):
+                    return df
+            except Exception:
+                pass
+            # Copia dañada o de una versión anterior: se vuelve a generar desde el CSV
+
+    # 1. Abrir ZIP
+    with zipfile.ZipFile(archivo_zip) as z:
+        archivos_csv = [f for f in z.namelist() if f.endswith('.csv') and '__MACOSX' not in f]
+        if not archivos_csv: return pd.DataFrame()
+
+        # 2. Limpieza y Tipos de Datos
+        # Buffer de 128 KB: menos llamadas a zlib por cada lectura del parser
+        with z.open(archivos_csv[0]) as raw:
+            f = io.BufferedReader(raw, buffer_size=128 * 1024)
+            df = pd.read_csv(f, usecols=columnas, dtype=tipos, engine='pyarrow')
+
+    # Fechas (con formato explícito para no caer en el parseo lento por fila)
+    df['fecha'] = pd.to_datetime(df['fecha'], errors='coerce', format='ISO8601')
+    if df['fecha'].dt.tz is not None:
+        # groupby/resample sobre un índice con zona horaria es mucho más lento
+        df['fecha'] = df['fecha'].dt.tz_localize(None)
+    df = df.dropna(subset=['fecha']).set_index('fecha')  # Sin fecha no se puede filtrar por periodo
+    df.sort_index(inplace=True)  # El CSV ya viene ordenado por fecha: casi no cuesta
+    df['anio'] = df.index.year.astype('int16')  # Calculado una vez para todos los filtros
+
+    # 3. Guardar copia Parquet para los próximos arranques en frío
+    # (en un temporal y luego os.replace: nunca queda a medias con el nombre definitivo)
+    archivo_tmp = f"{archivo_parquet}.{os.getpid()}.tmp"
     try:
-        # 1. Cargar diccionarios
-        diccionarios = cargar_maestros()
+        df.to_parquet(archivo_tmp, compression='zstd')
+        os.replace(archivo_tmp, archivo_parquet)
+    except OSError as e:
+        st.warning(f"⚠️ No se pudo guardar la copia Parquet: {e}")
+        if os.path.exists(archivo_tmp):
+            os.remove(archivo_tmp)
+
+    return df
+
+@st.cache_data(persist="disk")
+def cargar_datos(marcas, usar_maestros=True):
+    """Carga y limpia los datos automáticamente desde el ZIP local.
+    
+    `marcas` (ZIP, master_data.xlsx) solo es la clave de la caché. Los errores se propagan
+    en lugar de devolver un DataFrame vacío, para que no queden guardados en disco.
+    Con `usar_maestros=False` no se traducen los códigos (recurso si falla master_data.xlsx).
+    """
+    _, marca_meta = marcas
+    
+    # 1. CSV ya tipado (desde la copia Parquet: editar master_data.xlsx no obliga a releer el CSV)
+    df = _parse_csv(ARCHIVO_ZIP)
+    if df.empty: return df
+
+    # 2. Cargar diccionarios
+    diccionarios = cargar_maestros(marca_meta) if usar_maestros else {}
+
+    # 3. Traducción (IDs -> Nombres) usando los diccionarios
+    # Como 'category': pocos valores distintos repetidos en muchas filas
+    # Comunidades
+    if 'idcomunidad' in df.columns and 'comunidades' in diccionarios:
+        df['nombre_comunidad'] = df['idcomunidad'].map(diccionarios['comunidades']).fillna("Desconocido").astype('category')
+    else:
+        df['nombre_comunidad'] = "N/A"
+
+    # Provincias
+    if 'idprovincia' in df.columns and 'provincias' in diccionarios:
+        df['nombre_provincia'] = df['idprovincia'].map(diccionarios['provincias']).fillna("Desconocido").astype('category')
+    else:
+        df['nombre_provincia'] = "N/A"
         
-        # 2. Abrir ZIP
-        with zipfile.ZipFile(archivo_zip) as z:
-            archivos_csv = [f for f in z.namelist() if f.endswith('.csv') and '__MACOSX' not in f]
-            if not archivos_csv: return pd.DataFrame()
-
-            with z.open(archivos_csv[0]) as f:
-                df = pd.read_csv(f)
-
-        # 3. Limpieza y Tipos de Datos
-        # Fechas
-        col_fecha = next((c for c in df.columns if 'fecha' in c.lower() or 'date' in c.lower()), None)
-        if col_fecha:
-            df['fecha'] = pd.to_datetime(df[col_fecha], errors='coerce')
-            df.set_index('fecha', inplace=True)
-            df.sort_index(inplace=True)
-
-        # Coordenadas
-        df.rename(columns={'lat': 'lat', 'lng': 'lng'}, inplace=True) # Asegurar nombres
-        cols_num = ['superficie', 'gastos', 'perdidas', 'lat', 'lng', 'idcomunidad', 'idprovincia']
-        for col in cols_num:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-
-        # 4. Traducción (IDs -> Nombres) usando los diccionarios
-        # Comunidades
-        if 'idcomunidad' in df.columns and 'comunidades' in diccionarios:
-            df['nombre_comunidad'] = df['idcomunidad'].map(diccionarios['comunidades']).fillna("Desconocido")
-        else:
-            df['nombre_comunidad'] = "N/A"
-
-        # Provincias
-        if 'idprovincia' in df.columns and 'provincias' in diccionarios:
-            df['nombre_provincia'] = df['idprovincia'].map(diccionarios['provincias']).fillna("Desconocido")
-        else:
-            df['nombre_provincia'] = "N/A"
-            
-        # Causas (Mapeo robusto)
-        col_causa = 'causa' if 'causa' in df.columns else 'idcausa'
-        if col_causa in df.columns and 'causas' in diccionarios:
-             df['causa_texto'] = df[col_causa].map(diccionarios['causas']).fillna("No especificado")
-        else:
-             df['causa_texto'] = "Sin datos"
-
-        return df
-
-    except FileNotFoundError:
-        st.error(f"❌ No encuentro el archivo '{archivo_zip}'. Asegúrate de que está en la carpeta.")
-        return pd.DataFrame()
-    except Exception as e:
-        st.error(f"❌ Error crítico cargando datos: {e}")
-        return pd.DataFrame()
+    # Causas
+    if 'causa' in df.columns and 'causas' in diccionarios:
+         df['causa_texto'] = df['causa'].map(diccionarios['causas']).fillna("No especificado").astype('category')
+    else:
+         df['causa_texto'] = "Sin datos"
 
-# Cargar datos al inicio
-df = cargar_datos()
+    return df
+
+@st.cache_data
+def obtener_opciones(_df, marcas, usar_maestros):
+    """Opciones de los filtros, calculadas una sola vez sobre el dataset completo.
+    
+    `marcas` y `usar_maestros` (los mismos de cargar_datos) solo son la clave de la caché.
+    """
+    years = sorted(_df['anio'].unique().tolist())
+    comunidades = sorted(_df['nombre_comunidad'].unique().tolist())
+    # Provincias disponibles para cada comunidad (y todas, si no se elige ninguna)
+    provincias = {
+        com: sorted(grupo.unique().tolist())
+        for com, grupo in _df.groupby('nombre_comunidad', observed=True)['nombre_provincia']
+    }
+    provincias["Todas"] = sorted(_df['nombre_provincia'].unique().tolist())
+    return years, comunidades, provincias
+
+# Cargar datos al inicio (las cachés se invalidan cuando cambia alguno de los archivos;
+# la de cargar_datos persiste en disco entre reinicios)
+marcas = (marca_archivo(ARCHIVO_ZIP), marca_archivo(ARCHIVO_META))
+usar_maestros = True
+try:
+    try:
+        df = cargar_datos(marcas)
+    except ErrorMaestros as e:
+        # Se reintenta en cada ejecución; mientras, datos sin traducir (en su propia entrada de caché)
+        st.warning(f"⚠️ No se pudo cargar master_data.xlsx: {e}")
+        usar_maestros = False
+        df = cargar_datos(marcas, usar_maestros=False)
+except FileNotFoundError:
+    st.error(f"❌ No encuentro el archivo '{ARCHIVO_ZIP}'. Asegúrate de que está en la carpeta.")
+    df = pd.DataFrame()
+except Exception as e:
+    st.error(f"❌ Error crítico cargando datos: {e}")
+    df = pd.DataFrame()
 
 if df.empty:
     st.stop()
 
+years, comunidades, provincias = obtener_opciones(df, marcas, usar_maestros)
+
 # ------------------------------------------------------
 # 3. BARRA LATERAL (FILTROS)
 # ------------------------------------------------------
 st.sidebar.title("🔍 Filtros")
 
 # A. Años
-years = sorted(df.index.year.unique())
 rango_anos = st.sidebar.select_slider("Periodo", options=years, value=(min(years), max(years)))
-df_filtrado = df[(df.index.year >= rango_anos[0]) & (df.index.year <= rango_anos[1])]
 
 # B. Comunidad
-opts_com = ["Todas"] + sorted(df_filtrado['nombre_comunidad'].unique().tolist())
+opts_com = ["Todas"] + comunidades
 sel_com = st.sidebar.selectbox("Comunidad", opts_com)
-if sel_com != "Todas":
-    df_filtrado = df_filtrado[df_filtrado['nombre_comunidad'] == sel_com]
 
 # C. Provincia
-opts_prov = ["Todas"] + sorted(df_filtrado['nombre_provincia'].unique().tolist())
+opts_prov = ["Todas"] + provincias.get(sel_com, [])
 sel_prov = st.sidebar.selectbox("Provincia", opts_prov)
-if sel_prov != "Todas":
-    df_filtrado = df_filtrado[df_filtrado['nombre_provincia'] == sel_prov]
 
 # D. Superficie Mínima (Slider para quitar incendios pequeños del mapa)
 min_sup = st.sidebar.slider("Superficie mínima (ha)", 0, 500, 0, help="Filtra incendios pequeños")
-df_filtrado = df_filtrado[df_filtrado['superficie'] >= min_sup]
+
+# Una sola máscara combinada: se copia el DataFrame una vez, no una por filtro
+mask = df['anio'].between(*rango_anos) & (df['superficie'] >= min_sup)
+if sel_com != "Todas":
+    mask &= df['nombre_comunidad'].eq(sel_com)
+if sel_prov != "Todas":
+    mask &= df['nombre_provincia'].eq(sel_prov)
+df_filtrado = df[mask]
 
 # ------------------------------------------------------
 # 4. DASHBOARD
@@ -146,12 +235,13 @@ df_filtrado = df_filtrado[df_filtrado['superficie'] >= min_sup]
 st.title("🔥 Monitor de Incendios Forestales")
 st.markdown(f"Visualizando **{len(df_filtrado):,}** incendios entre **{rango_anos[0]}** y **{rango_anos[1]}**.")
 
-# KPIs
+# KPIs (las columnas se guardan en float32; los totales se acumulan en float64)
+totales = df_filtrado[['superficie', 'gastos', 'perdidas']].astype('float64').sum()
 k1, k2, k3, k4 = st.columns(4)
 k1.metric("Incendios", f"{len(df_filtrado):,}")
-k2.metric("Hectáreas Quemadas", f"{df_filtrado['superficie'].sum():,.0f} ha")
-k3.metric("Gastos Extinción", f"{df_filtrado['gastos'].fillna(0).sum():,.0f} €")
-k4.metric("Pérdidas Estimadas", f"{df_filtrado['perdidas'].fillna(0).sum():,.0f} €")
+k2.metric("Hectáreas Quemadas", f"{totales['superficie']:,.0f} ha")
+k3.metric("Gastos Extinción", f"{totales['gastos']:,.0f} €")
+k4.metric("Pérdidas Estimadas", f"{totales['perdidas']:,.0f} €")
 
 st.divider()
 
@@ -164,15 +254,30 @@ tab1, tab2 = st.tabs(["🔥 Mapa de Calor (Densidad)", "📍 Puntos Agrupados (C
 df_geo = df_filtrado.dropna(subset=['lat', 'lng'])
 
 if not df_geo.empty:
+    # Importaciones pesadas solo cuando hay algo que pintar
+    import folium
+    from folium.plugins import FastMarkerCluster, HeatMap, Fullscreen
+    from streamlit_folium import st_folium
+
     # Calculamos centro
     centro = [df_geo['lat'].mean(), df_geo['lng'].mean()]
     
     # -- Pestaña 1: HEATMAP --
     with tab1:
         m1 = folium.Map(location=centro, zoom_start=6, tiles="CartoDB positron")
+        # ndarray directo (float64: np.float32 no es serializable a JSON)
+        datos_calor = df_geo[['lat', 'lng', 'superficie']].to_numpy(dtype='float64')
+        
+        # Por encima de ~50.000 puntos la densidad no cambia a la vista;
+        # muestreamos (con semilla fija para que el mapa no "baile" entre recargas)
+        max_calor = 50000
+        if len(datos_calor) > max_calor:
+            idx = np.random.default_rng(0).choice(len(datos_calor), max_calor, replace=False)
+            datos_calor = datos_calor[idx]
+        
         # El mapa de calor es genial para ver "zonas calientes" sin saturar
         HeatMap(
-            data=df_geo[['lat', 'lng', 'superficie']].values.tolist(),
+            data=datos_calor,
             radius=15,
             blur=20,
             max_zoom=10
@@ -183,29 +288,43 @@ if not df_geo.empty:
     # -- Pestaña 2: CLUSTERS --
     with tab2:
         m2 = folium.Map(location=centro, zoom_start=6)
-        marker_cluster = MarkerCluster().add_to(m2)
         
         # Limitamos a 2000 puntos para que no explote el navegador si hay muchos
         # Si hay más, mostramos aviso
         limit = 2000
-        df_display = df_geo.head(limit)
+        df_display = df_geo.iloc[::-1].head(limit)  # Índice ya ordenado: los más recientes, sin reordenar
         
         if len(df_geo) > limit:
             st.warning(f"⚠️ Mostrando los {limit} incendios más recientes en este modo para mantener fluidez.")
         
-        for idx, row in df_display.iterrows():
-            # Color dinámico
-            sup = row['superficie']
-            color = "red" if sup > 100 else "orange" if sup > 10 else "green"
-            
-            folium.CircleMarker(
-                location=[row['lat'], row['lng']],
-                radius=5,
-                color=color,
-                fill=True,
-                fill_color=color,
-                popup=f"<b>{row.get('municipio','?')}</b><br>Sup: {sup:.1f} ha<br>{row.get('causa_texto','')}"
-            ).add_to(marker_cluster)
+        # Una sola lista plana (un único blob JSON) en lugar de un marcador folium por incendio;
+        # cada marcador y su popup se crean en el navegador y los agrupa leaflet.markercluster
+        # Popup y color de cada punto con operaciones vectorizadas (sin f-string por fila)
+        sup = df_display['superficie']
+        popups = (
+            '<b>' + df_display['municipio'].fillna('?').astype(str)
+            # Redondeo en float64, igual que el f"{sup:.1f}" original (en float32 1.45 quedaría 1.4)
+            + '</b><br>Sup: ' + sup.astype('float64').round(1).astype(str)
+            + ' ha<br>' + df_display['causa_texto'].astype(str)
+        )
+        # Color dinámico
+        colores = np.select([sup > 100, sup > 10], ["red", "orange"], "green")
+        
+        # Filas [lat, lng, popup, color] ensambladas por zip, sin código Python por fila
+        datos_puntos = list(zip(df_display['lat'].tolist(), df_display['lng'].tolist(),
+                                popups.tolist(), colores.tolist()))
+        
+        # El popup se enlaza a cada marcador: enlazado a una capa agrupada no llega a abrirse
+        callback = """
+        function (row) {
+            var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+                radius: 5, color: row[3], fill: true, fillColor: row[3]
+            });
+            marker.bindPopup(row[2]);
+            return marker;
+        }
+        """
+        FastMarkerCluster(datos_puntos, callback=callback).add_to(m2)
             
         Fullscreen().add_to(m2)
         st_folium(m2, width="100%", height=500)
@@ -215,14 +334,20 @@ else:
 st.divider()
 
 # --- GRÁFICOS ---
+import plotly.express as px
+
 c1, c2 = st.columns(2)
 
 with c1:
     st.subheader("📈 Tendencia Temporal")
-    df_anual = df_filtrado.resample('YE')['superficie'].sum().reset_index()
+    # Acumulado en float64, como los KPIs (la columna se guarda en float32)
+    df_anual = df_filtrado['superficie'].astype('float64').groupby(df_filtrado['anio']).sum()
     if not df_anual.empty:
-        fig_line = px.line(df_anual, x='fecha', y='superficie', markers=True, 
-                           labels={'superficie': 'Hectáreas', 'fecha': 'Año'})
+        # Los años sin incendios quedan a 0, igual que con resample('YE')
+        anios = pd.RangeIndex(df_anual.index.min(), df_anual.index.max() + 1, name='anio')
+        df_anual = df_anual.reindex(anios, fill_value=0).reset_index()
+        fig_line = px.line(df_anual, x='anio', y='superficie', markers=True, 
+                           labels={'superficie': 'Hectáreas', 'anio': 'Año'})
         st.plotly_chart(fig_line, width="stretch")
 
 with c2:
@@ -235,4 +360,5 @@ with c2:
 
 # --- TABLA ---
 with st.expander("📂 Ver Datos Detallados"):
-    st.dataframe(df_filtrado.sort_index(ascending=False).head(1000), use_container_width=True)
+    # Índice ya ordenado en la carga: los más recientes primero sin reordenar en cada ejecución
+    st.dataframe(df_filtrado.iloc[::-1].head(1000), use_container_width=True)